@@ -1,16 +1,146 @@
 #!/usr/bin/env python3
+import gc
 import json
 import os
 import sys
 import threading
 import time
-import requests
+import urllib3
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Any, Dict, Optional, List
 
+try:
+    # Optional: pip install orjson
+    import orjson
+except Exception:
+    orjson = None
 
-def _send(obj: Dict[str, Any]) -> None:
-    sys.stdout.write(json.dumps(obj, ensure_ascii=False) + "\n")
-    sys.stdout.flush()
+
+def _env_int(name: str, default: int) -> int:
+    # Positive integer from the environment ("2e9" style accepted); anything
+    # else falls back to the default instead of failing at import.
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    try:
+        parsed = int(float(value))
+    except (ValueError, OverflowError):
+        parsed = 0
+    if parsed <= 0:
+        print(f"Ignoring {name}={value!r}: expected a positive integer", file=sys.stderr)
+        return default
+    return parsed
+
+
+# Number of repo files fetched concurrently by download_model.
+_DOWNLOAD_WORKERS = 8
+
+# Files at least this large go through hf_transfer (when installed), which splits
+# them into parallel ranged requests handled in Rust. Set CEREBRO_HF_TRANSFER=0
+# to turn this off.
+_HF_TRANSFER_MIN_SIZE = 64 * 1024 * 1024
+_HF_TRANSFER = os.environ.get("CEREBRO_HF_TRANSFER", "1") != "0"
+
+# Without hf_transfer, files at least this large are fetched as this many
+# parallel ranged GETs written straight to their offsets.
+_RANGE_MIN_SIZE = 64 * 1024 * 1024
+_RANGE_PARTS = 8
+
+# How often (seconds) a running download records its resume state.
+_PROGRESS_SAVE_INTERVAL = 1.0
+
+# Streamed text is buffered and sent as one chat_token frame once it reaches this
+# many characters or this many seconds pass since the last frame (~30 Hz still
+# reads as smooth).
+_TOKEN_FLUSH_CHARS = 32
+_TOKEN_FLUSH_INTERVAL = 0.033
+
+# Opt-in (CEREBRO_TORCH_COMPILE=1): on CUDA, decode with a static KV cache of
+# _STATIC_CACHE_LEN tokens so transformers compiles the per-token forward once
+# and replays it as a CUDA graph. Requests that would not fit use the regular
+# dynamic cache instead of recompiling for a new cache size.
+_TORCH_COMPILE = os.environ.get("CEREBRO_TORCH_COMPILE", "0") == "1"
+_STATIC_CACHE_LEN = _env_int("CEREBRO_STATIC_CACHE_LEN", 4096)
+
+# Opt-in (CEREBRO_QUANTIZE=1): models with at least this many (estimated)
+# parameters get int8 weights, via bitsandbytes on CUDA and torchao on CPU.
+# Both change outputs slightly, and bitsandbytes int8 / uncompiled torchao are
+# not reliably faster than bfloat16, so nothing is quantized by default.
+_QUANTIZE = os.environ.get("CEREBRO_QUANTIZE", "0") == "1"
+_QUANT_MIN_PARAMS = _env_int("CEREBRO_QUANT_MIN_PARAMS", 2 * 10**9)
+
+# Read size for streamed downloads. Bigger chunks mean fewer trips through the
+# Python loop per GB; override with CEREBRO_DL_CHUNK (bytes).
+_CHUNK_SIZE = _env_int("CEREBRO_DL_CHUNK", 8 * 1024 * 1024)
+
+# Bytes of queued io_uring writes allowed in flight per file before
+# submitters wait for the disk.
+_URING_MAX_INFLIGHT = max(32 * 1024 * 1024, 2 * _CHUNK_SIZE)
+
+# Sent with every download request. Identity encoding keeps byte counts equal
+# to the file sizes reported by the Hub.
+_DEFAULT_HEADERS = {
+    "User-Agent": "cerebro/0.1 (tauri; python)",
+    "Accept-Encoding": "identity",
+}
+
+# Shared, thread-safe connection pools for all file downloads, so TCP/TLS
+# connections to the Hub and its CDN are reused across files. Socket buffers are
+# left to the kernel: an explicit SO_RCVBUF would turn off TCP autotuning.
+_HTTP = urllib3.PoolManager(
+    num_pools=16,
+    maxsize=32,
+    headers=_DEFAULT_HEADERS,
+    retries=urllib3.Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=[502, 503, 504],
+        raise_on_status=False,
+    ),
+)
+
+
+if orjson is not None:
+
+    def _send(obj: Dict[str, Any]) -> None:
+        # One bytes write per message, so concurrent senders never interleave.
+        out = sys.stdout.buffer
+        out.write(orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE))
+        out.flush()
+
+else:
+
+    def _send(obj: Dict[str, Any]) -> None:
+        sys.stdout.write(json.dumps(obj, ensure_ascii=False) + "\n")
+        sys.stdout.flush()
+
+
+# Parses one message from bytes; both accept bytes without a decode step.
+_loads = orjson.loads if orjson is not None else json.loads
+
+
+def _stdin_lines():
+    """Yield newline-framed messages from stdin as raw bytes.
+
+    Plain blocking os.read calls: they work the same for pipes, regular files
+    and /dev/null, which epoll-based selectors refuse to register.
+    """
+
+    fd = sys.stdin.buffer.fileno()
+    buf = bytearray()
+    while True:
+        data = os.read(fd, 64 * 1024)
+        if not data:
+            if buf:
+                yield bytes(buf)
+            return
+        buf += data
+        while True:
+            end = buf.find(b"\n")
+            if end < 0:
+                break
+            yield bytes(buf[:end])
+            del buf[: end + 1]
 
 def _import_hf_hub():
     try:
@@ -22,30 +152,453 @@ def _import_hf_hub():
     return HfApi, hf_hub_download, hf_hub_url
 
 
-def _file_expected_size_from_model_info(info, filename: str) -> Optional[int]:
+def _import_hf_transfer():
+    # Optional fast path: pip install hf_transfer
+    if not _HF_TRANSFER:
+        return None
     try:
-        for s in getattr(info, "siblings", []) or []:
-            if getattr(s, "rfilename", None) != filename:
-                continue
-            # huggingface_hub may provide size directly, and/or an LFS blob size.
-            size = getattr(s, "size", None)
-            if isinstance(size, int) and size > 0:
-                return size
-            lfs = getattr(s, "lfs", None)
-            lfs_size = getattr(lfs, "size", None) if lfs is not None else None
-            if isinstance(lfs_size, int) and lfs_size > 0:
-                return lfs_size
+        import hf_transfer
+    except Exception:
+        return None
+    return hf_transfer
+
+
+def _sibling_size(sibling) -> Optional[int]:
+    try:
+        # huggingface_hub may provide size directly, and/or an LFS blob size.
+        size = getattr(sibling, "size", None)
+        if isinstance(size, int) and size > 0:
+            return size
+        lfs = getattr(sibling, "lfs", None)
+        lfs_size = getattr(lfs, "size", None) if lfs is not None else None
+        if isinstance(lfs_size, int) and lfs_size > 0:
+            return lfs_size
     except Exception:
         pass
     return None
 
 
+def _discard(resp) -> None:
+    # Close before releasing so a half-read body never goes back into the pool.
+    resp.close()
+    resp.release_conn()
+
+
 def _ensure_parent_dir(path: str) -> None:
     parent = os.path.dirname(path)
     if parent:
         os.makedirs(parent, exist_ok=True)
 
 
+def _import_liburing():
+    # Optional on Linux: pip install liburing
+    if sys.platform != "linux":
+        return None
+    try:
+        import liburing
+    except Exception:
+        return None
+    return liburing
+
+
+def _pwrite_all(fd: int, data, offset: int) -> None:
+    view = memoryview(data)
+    while view:
+        n = os.pwrite(fd, view, offset)
+        view = view[n:]
+        offset += n
+
+
+class _FdWriter:
+    """Sequential writes starting at ``offset`` with plain os calls."""
+
+    def __init__(self, fd: int, offset: int) -> None:
+        self.fd = fd
+        self.offset = offset
+        self.failed = False
+        if not hasattr(os, "pwrite"):
+            os.lseek(fd, offset, os.SEEK_SET)
+
+    @property
+    def done(self) -> int:
+        # Offset up to which every write has completed.
+        return self.offset
+
+    def write(self, chunk: bytes) -> None:
+        try:
+            if hasattr(os, "pwrite"):
+                _pwrite_all(self.fd, chunk, self.offset)
+            else:
+                view = memoryview(chunk)
+                while view:
+                    view = view[os.write(self.fd, view):]
+        except BaseException:
+            self.failed = True
+            raise
+        self.offset += len(chunk)
+
+    def close(self) -> None:
+        pass
+
+
+class _UringQueue:
+    """One io_uring shared by every writer of a file.
+
+    Writes are queued and return immediately, so sockets keep being read while
+    the kernel drains earlier writes. Completions are reaped after every submit;
+    a submitter only blocks while more than ``max_bytes`` are in flight across
+    all writers of the file. Each chunk stays referenced in ``_pending`` until
+    its completion arrives.
+    """
+
+    def __init__(self, liburing, fd: int, max_bytes: int, entries: int = 64) -> None:
+        self._lib = liburing
+        self._entries = entries
+        self._max_bytes = max_bytes
+        self._ring = liburing.Ring()
+        self._cqe = liburing.Cqe()
+        liburing.io_uring_queue_init(entries, self._ring, 0)
+        self._cond = threading.Condition()
+        self._pending: Dict[int, Any] = {}
+        self._inflight = 0
+        self._next_id = 0
+        self.fd = fd
+
+    def submit(self, writer: "_UringWriter", chunk: bytes, offset: int) -> None:
+        lib = self._lib
+        with self._cond:
+            while self._pending and (
+                self._inflight + len(chunk) > self._max_bytes or len(self._pending) >= self._entries
+            ):
+                self._reap(wait=True)
+            sqe = lib.io_uring_get_sqe(self._ring)
+            lib.io_uring_prep_write(sqe, self.fd, chunk, offset)
+            lib.io_uring_sqe_set_data64(sqe, self._next_id)
+            self._pending[self._next_id] = (chunk, offset, writer)
+            self._next_id += 1
+            self._inflight += len(chunk)
+            writer._offsets.add(offset)
+            lib.io_uring_submit(self._ring)
+            self._reap(wait=False)
+
+    def drain(self, writer: Optional["_UringWriter"] = None) -> None:
+        """Wait until ``writer``'s writes (or every write) have completed."""
+        with self._cond:
+            while self._pending and (writer is None or writer._offsets):
+                self._reap(wait=True)
+
+    def close(self) -> None:
+        try:
+            self.drain()
+        finally:
+            self._lib.io_uring_queue_exit(self._ring)
+
+    def _reap(self, wait: bool) -> None:
+        # Caller holds self._cond.
+        lib = self._lib
+        if wait:
+            lib.io_uring_wait_cqe(self._ring, self._cqe)
+            self._complete(self._cqe[0])
+            lib.io_uring_cq_advance(self._ring, 1)
+        for _ in range(lib.io_uring_cq_ready(self._ring)):
+            lib.io_uring_peek_cqe(self._ring, self._cqe)
+            self._complete(self._cqe[0])
+            lib.io_uring_cq_advance(self._ring, 1)
+
+    def _complete(self, entry) -> None:
+        res = entry.res
+        chunk, offset, writer = self._pending.pop(entry.user_data)
+        self._inflight -= len(chunk)
+        try:
+            if res < 0:
+                raise OSError(-res, os.strerror(-res))
+            if res < len(chunk):
+                # Short write: finish the rest synchronously.
+                _pwrite_all(self.fd, memoryview(chunk)[res:], offset + res)
+        except OSError as e:
+            writer.failed = True
+            writer.error = writer.error or e
+        finally:
+            writer._offsets.discard(offset)
+
+
+class _UringWriter:
+    """Sequential writes starting at ``offset`` through a shared _UringQueue.
+
+    A failed write is reported by the next write() or close() of this writer.
+    """
+
+    def __init__(self, queue: _UringQueue, offset: int) -> None:
+        self._queue = queue
+        # Start offsets of this writer's chunks still in flight.
+        self._offsets: set = set()
+        self.offset = offset
+        self.failed = False
+        self.error: Optional[OSError] = None
+
+    @property
+    def done(self) -> int:
+        # Offset up to which every write has completed.
+        with self._queue._cond:
+            offsets = self._offsets
+            if offsets:
+                self._queue._reap(wait=False)
+            return min(offsets) if offsets else self.offset
+
+    def write(self, chunk: bytes) -> None:
+        if self.error is not None:
+            raise self.error
+        self._queue.submit(self, chunk, self.offset)
+        self.offset += len(chunk)
+
+    def close(self) -> None:
+        self._queue.drain(self)
+        if self.error is not None:
+            raise self.error
+
+
+def _open_write_queue(fd: int) -> Optional[_UringQueue]:
+    liburing = _import_liburing()
+    if liburing is not None:
+        try:
+            return _UringQueue(liburing, fd, max_bytes=_URING_MAX_INFLIGHT)
+        except Exception:
+            pass
+    return None
+
+
+def _open_writer(queue: Optional[_UringQueue], fd: int, offset: int):
+    if queue is not None:
+        return _UringWriter(queue, offset)
+    return _FdWriter(fd, offset)
+
+
+def _save_etag(dest_path: str, resp) -> None:
+    # Remember which version of the file the partial data belongs to.
+    etag = resp.headers.get("ETag")
+    if not etag:
+        return
+    try:
+        with open(dest_path + ".etag", "w") as f:
+            f.write(etag)
+    except Exception:
+        pass
+
+
+def _can_resume(url: str, headers: Dict[str, str], dest_path: str, expected_size: Optional[int]) -> bool:
+    """HEAD the file to check a Range GET would continue the partial we have.
+
+    Requires byte ranges, a matching size, and (when one was saved) the same
+    ETag as when the partial was started.
+    """
+
+    try:
+        head = _HTTP.request("HEAD", url, headers=headers, timeout=30.0)
+    except urllib3.exceptions.HTTPError:
+        return False
+    if head.status >= 400 or head.headers.get("Accept-Ranges") != "bytes":
+        return False
+
+    length = head.headers.get("Content-Length")
+    if expected_size is not None and (length is None or not length.isdigit() or int(length) != expected_size):
+        return False
+
+    try:
+        with open(dest_path + ".etag") as f:
+            stored = f.read().strip()
+    except Exception:
+        stored = ""
+    etag = head.headers.get("ETag")
+    return not (stored and etag and stored != etag)
+
+
+def _load_parts(dest_path: str, expected_size: int) -> Optional[List[List[int]]]:
+    """Read the resume state saved next to a partial download.
+
+    Each part is ``[start, stop, done]``: bytes [start, done) of the part are
+    known to be on disk. Returns None when there is no usable state.
+    """
+
+    try:
+        with open(dest_path + ".progress") as f:
+            data = json.load(f)
+        if data.get("size") != expected_size:
+            return None
+        parts = [[int(start), int(stop), int(done)] for start, stop, done in data["parts"]]
+    except Exception:
+        return None
+    if not parts or any(not (start <= done <= stop) for start, stop, done in parts):
+        return None
+    return parts
+
+
+def _save_parts(dest_path: str, expected_size: int, parts: List[List[int]]) -> None:
+    # Written to a side file and renamed, so a kill mid-write never leaves a
+    # truncated state behind.
+    path = dest_path + ".progress"
+    try:
+        with open(path + ".tmp", "w") as f:
+            json.dump({"size": expected_size, "parts": parts}, f)
+        os.replace(path + ".tmp", path)
+    except Exception:
+        pass
+
+
+def _remove_quietly(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _commit_download(tmp_path: str, dest_path: str, written: int, expected_size: Optional[int]) -> None:
+    if expected_size is not None and written != expected_size:
+        raise RuntimeError(
+            f"Incomplete download: got {written} of {expected_size} bytes"
+        )
+    os.replace(tmp_path, dest_path)
+    _remove_quietly(dest_path + ".etag")
+    _remove_quietly(dest_path + ".progress")
+
+
+def _download_ranges(
+    *,
+    url: str,
+    headers: Dict[str, str],
+    dest_path: str,
+    tmp_path: str,
+    parts: List[List[int]],
+    expected_size: int,
+    cancel_event: threading.Event,
+    on_progress,
+    overall_base: int,
+) -> Optional[int]:
+    """Fetch the unfinished ``parts`` of a file as parallel ranged GETs.
+
+    Each part is written at its absolute offset in tmp_path, and ``parts`` is
+    saved to dest_path + ".progress" as it advances, so any exit (including a
+    kill) can resume every part. Returns the bytes on disk for the file, or None
+    when the server does not honour ranges (nothing is written in that case).
+    """
+
+    todo = [i for i, (_start, stop, done) in enumerate(parts) if done < stop]
+    fresh = all(done == start for start, _stop, done in parts)
+    if not todo:
+        # Finished before a previous run could move the file into place.
+        return expected_size
+
+    def _request(start: int, stop: int):
+        return _HTTP.request(
+            "GET",
+            url,
+            headers={**headers, "Range": f"bytes={start}-{stop - 1}"},
+            preload_content=False,
+            timeout=60.0,
+        )
+
+    # Probe with the first part; anything but a matching 206 means no ranges.
+    _first_start, first_stop, first_done = parts[todo[0]]
+    first = _request(first_done, first_stop)
+    if first.status != 206 or not first.headers.get("Content-Range", "").startswith(f"bytes {first_done}-"):
+        _discard(first)
+        return None
+    if fresh:
+        _save_etag(dest_path, first)
+
+    flags = os.O_WRONLY | os.O_CREAT | getattr(os, "O_BINARY", 0)
+    if fresh:
+        flags |= os.O_TRUNC
+    try:
+        fd = os.open(tmp_path, flags, 0o644)
+    except BaseException:
+        _discard(first)
+        raise
+
+    queue = _open_write_queue(fd)
+    received = [done for _start, _stop, done in parts]
+    writers: Dict[int, Any] = {}
+    lock = threading.Lock()
+    abort = threading.Event()
+    write_failed = False
+    last_save = time.monotonic()
+
+    def snapshot() -> None:
+        # Caller holds lock.
+        for i, writer in writers.items():
+            parts[i][2] = writer.done
+        _save_parts(dest_path, expected_size, parts)
+
+    def fetch_part(i: int, resp) -> None:
+        nonlocal write_failed, last_save
+        _start, stop, done = parts[i]
+        if resp is None:
+            resp = _request(done, stop)
+            if resp.status != 206:
+                _discard(resp)
+                raise RuntimeError(f"HTTP error downloading file: HTTP {resp.status}")
+        writer = None
+        try:
+            writer = _open_writer(queue, fd, done)
+            with lock:
+                writers[i] = writer
+            for chunk in resp.stream(_CHUNK_SIZE, decode_content=False):
+                if cancel_event.is_set():
+                    raise RuntimeError("Download cancelled")
+                if abort.is_set():
+                    raise RuntimeError("Download aborted")
+                if not chunk:
+                    continue
+                writer.write(chunk)
+                with lock:
+                    received[i] += len(chunk)
+                    n = sum(r - part[0] for r, part in zip(received, parts))
+                    now = time.monotonic()
+                    if now - last_save >= _PROGRESS_SAVE_INTERVAL:
+                        last_save = now
+                        snapshot()
+                on_progress(overall_base + n)
+        except BaseException:
+            abort.set()
+            _discard(resp)
+            raise
+        finally:
+            resp.release_conn()
+            if writer is not None:
+                try:
+                    writer.close()
+                finally:
+                    if writer.failed:
+                        write_failed = True
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(todo)) as pool:
+            futures = [pool.submit(fetch_part, todo[0], first)]
+            futures += [pool.submit(fetch_part, i, None) for i in todo[1:]]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+            except BaseException:
+                abort.set()
+                raise
+    finally:
+        try:
+            if queue is not None:
+                queue.close()
+        finally:
+            try:
+                if write_failed:
+                    # A failed disk write may have left a hole; start over then.
+                    _remove_quietly(dest_path + ".progress")
+                    os.ftruncate(fd, 0)
+                else:
+                    with lock:
+                        snapshot()
+            finally:
+                os.close(fd)
+
+    return sum(done - start for start, _stop, done in parts)
+
+
 def _download_streaming(
     *,
     url: str,
@@ -58,105 +611,520 @@ def _download_streaming(
 ) -> int:
     """Download a single file with streaming + resume.
 
+    Large files with a known size are split into parallel ranged GETs;
+    otherwise (or when the server ignores ranges) one stream is used. Partial
+    data is kept in ``dest_path + ".incomplete"`` and renamed into place once
+    the transfer finishes, so a file at dest_path is always complete.
+
     Returns bytes written for this file (including any resumed bytes already on disk).
     """
 
     _ensure_parent_dir(dest_path)
+    tmp_path = dest_path + ".incomplete"
 
-    existing = 0
     if os.path.exists(dest_path):
-        try:
-            existing = int(os.path.getsize(dest_path))
-        except Exception:
-            existing = 0
+        size = int(os.path.getsize(dest_path))
 
         # If we already have the full file, skip.
-        if expected_size is not None and existing == expected_size:
-            return existing
-
-        # If local file is larger than expected, restart.
-        if expected_size is not None and existing > expected_size:
-            try:
-                os.remove(dest_path)
-            except Exception:
-                pass
-            existing = 0
-
-    headers = {
-        # Avoid transparent decompression changing byte counts
-        "Accept-Encoding": "identity",
-        "User-Agent": "cerebro/0.1 (tauri; python)",
-    }
+        if expected_size is None or size == expected_size:
+            return size
+
+        # Older runners resumed in place; pick that partial up as the temp file.
+        if size < expected_size and not os.path.exists(tmp_path):
+            os.replace(dest_path, tmp_path)
+            _save_parts(dest_path, expected_size, [[0, expected_size, size]])
+        else:
+            os.remove(dest_path)
+
+    # Resume state lives in dest_path + ".progress", saved while downloading.
+    # The temp file size is not trusted: ranged and queued writes land out of
+    # order, so it can run past data that never reached the disk.
+    parts = None
+    if expected_size is not None and os.path.exists(tmp_path):
+        parts = _load_parts(dest_path, expected_size)
+    if parts is not None and all(done == start for start, _stop, done in parts):
+        parts = None
+
+    headers = dict(_DEFAULT_HEADERS)
     if token:
         headers["Authorization"] = f"Bearer {token}"
 
-    mode = "ab" if existing > 0 else "wb"
-    if existing > 0:
-        headers["Range"] = f"bytes={existing}-"
+    # Only resume when a cheap HEAD says the Range GET would continue this exact
+    # file; otherwise start fresh instead of finding out after a wasted GET.
+    if parts is not None and not _can_resume(url, headers, dest_path, expected_size):
+        print(f"Cannot resume {dest_path}, restarting", file=sys.stderr)
+        parts = None
 
     try:
-        chunk_size = 1024 * 1024  # 1MB
-        written = existing
-        last_emit_t = 0.0
-        last_emit_bytes = existing
-
         def _request(stream_headers: Dict[str, str]):
-            return requests.get(
+            return _HTTP.request(
+                "GET",
                 url,
                 headers=stream_headers,
-                stream=True,
-                timeout=60,
-                allow_redirects=True,
+                preload_content=False,
+                timeout=60.0,
             )
 
+        ranged = (parts is not None and len(parts) > 1) or (
+            parts is None and expected_size is not None and expected_size >= _RANGE_MIN_SIZE
+        )
+        if ranged:
+            if parts is None:
+                step = -(-expected_size // _RANGE_PARTS)
+                parts = [
+                    [start, min(start + step, expected_size), start]
+                    for start in range(0, expected_size, step)
+                ]
+            written = _download_ranges(
+                url=url,
+                headers=headers,
+                dest_path=dest_path,
+                tmp_path=tmp_path,
+                parts=parts,
+                expected_size=expected_size,
+                cancel_event=cancel_event,
+                on_progress=on_progress,
+                overall_base=overall_base,
+            )
+            if written is not None:
+                _commit_download(tmp_path, dest_path, written, expected_size)
+                on_progress(overall_base + written)
+                return written
+            # Server ignores ranges: one stream from the start.
+            parts = None
+
+        existing = parts[0][2] if parts is not None else 0
+        if existing > 0:
+            headers["Range"] = f"bytes={existing}-"
+
         resp = _request(headers)
 
         # If server ignored Range, restart from scratch
-        if existing > 0 and resp.status_code != 206:
-            resp.close()
+        if existing > 0 and resp.status != 206:
+            _discard(resp)
             existing = 0
-            written = 0
-            mode = "wb"
             headers.pop("Range", None)
             resp = _request(headers)
 
-        if resp.status_code >= 400:
-            msg = f"HTTP {resp.status_code}"
+        if resp.status >= 400:
+            msg = f"HTTP {resp.status}"
             try:
-                msg = f"HTTP {resp.status_code}: {resp.text[:200]}"
+                msg = f"HTTP {resp.status}: {resp.read(200).decode('utf-8', 'replace')}"
             except Exception:
                 pass
+            _discard(resp)
             raise RuntimeError(f"HTTP error downloading file: {msg}")
 
-        with open(dest_path, mode) as f:
-            for chunk in resp.iter_content(chunk_size=chunk_size):
+        if existing == 0:
+            _save_etag(dest_path, resp)
+
+        written = existing
+        flags = os.O_WRONLY | os.O_CREAT | getattr(os, "O_BINARY", 0)
+        if existing == 0:
+            flags |= os.O_TRUNC
+        try:
+            fd = os.open(tmp_path, flags, 0o644)
+        except BaseException:
+            _discard(resp)
+            raise
+        writer = None
+        queue = None
+        try:
+            queue = _open_write_queue(fd)
+            writer = _open_writer(queue, fd, existing)
+            last_save = time.monotonic()
+
+            # decode_content=False: write the raw bytes so counts match the
+            # server-side file size.
+            for chunk in resp.stream(_CHUNK_SIZE, decode_content=False):
                 if cancel_event.is_set():
                     raise RuntimeError("Download cancelled")
                 if not chunk:
                     continue
-                f.write(chunk)
+                writer.write(chunk)
                 written += len(chunk)
-
-                now = time.time()
-                if (written - last_emit_bytes) >= (1024 * 1024) or (now - last_emit_t) >= 0.25:
-                    last_emit_t = now
-                    last_emit_bytes = written
-                    on_progress(overall_base + written)
-
-        resp.close()
+                on_progress(overall_base + written)
+
+                if expected_size is not None:
+                    now = time.monotonic()
+                    if now - last_save >= _PROGRESS_SAVE_INTERVAL:
+                        last_save = now
+                        _save_parts(dest_path, expected_size, [[0, expected_size, writer.done]])
+        except BaseException:
+            _discard(resp)
+            raise
+        finally:
+            resp.release_conn()
+            try:
+                if writer is not None:
+                    writer.close()
+            finally:
+                try:
+                    if queue is not None:
+                        queue.close()
+                finally:
+                    # A failed disk write may have left a hole; start over then.
+                    failed = writer is not None and writer.failed
+                    if failed:
+                        _remove_quietly(dest_path + ".progress")
+                    elif expected_size is not None:
+                        _save_parts(dest_path, expected_size, [[0, expected_size, written]])
+                    try:
+                        os.ftruncate(fd, 0 if failed else written)
+                    finally:
+                        os.close(fd)
+
+        _commit_download(tmp_path, dest_path, written, expected_size)
         on_progress(overall_base + written)
         return written
-    except requests.RequestException as e:
+    except urllib3.exceptions.HTTPError as e:
         raise RuntimeError(f"Network error downloading file: {e}") from e
 
 
+def _has_partial(dest_path: str, expected_size: int) -> bool:
+    # Anything _download_streaming can resume from: a file left in place by an
+    # older runner, or a temp file with saved progress.
+    if os.path.exists(dest_path):
+        return True
+    if not os.path.exists(dest_path + ".incomplete"):
+        return False
+    parts = _load_parts(dest_path, expected_size)
+    return parts is not None and any(done > start for start, _stop, done in parts)
+
+
+def _download_hf_transfer(
+    *,
+    hf_transfer,
+    url: str,
+    dest_path: str,
+    token: Optional[str],
+    expected_size: int,
+    cancel_event: threading.Event,
+    on_progress,
+) -> int:
+    """Download a single file with hf_transfer's parallel ranged downloader.
+
+    hf_transfer cannot resume, so it is only used for files with nothing on disk
+    yet (see _has_partial). The file is written to a temporary path and moved
+    into place once complete. Returns bytes written.
+    """
+
+    _ensure_parent_dir(dest_path)
+    tmp_path = dest_path + ".incomplete"
+
+    headers = dict(_DEFAULT_HEADERS)
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+
+    written = 0
+
+    def callback(n_bytes: int) -> None:
+        # Called with the size of each chunk hf_transfer finishes.
+        nonlocal written
+        if cancel_event.is_set():
+            raise RuntimeError("Download cancelled")
+        written += int(n_bytes)
+        on_progress(written)
+
+    try:
+        hf_transfer.download(
+            url=url,
+            filename=tmp_path,
+            max_files=8,
+            chunk_size=10 * 1024 * 1024,
+            headers=headers,
+            callback=callback,
+        )
+    except Exception as e:
+        try:
+            os.remove(tmp_path)
+        except Exception:
+            pass
+        if cancel_event.is_set():
+            raise RuntimeError("Download cancelled") from e
+        raise RuntimeError(f"Network error downloading file: {e}") from e
+
+    written = int(os.path.getsize(tmp_path))
+    _commit_download(tmp_path, dest_path, written, expected_size)
+    on_progress(written)
+    return written
+
+
+def _as_text_message(msg: Dict[str, Any]) -> Dict[str, Any]:
+    # Qwen chat templates expect content as a plain string, not a list of parts.
+    if not isinstance(msg["content"], list):
+        return msg
+    combined_text = " ".join([part["text"] for part in msg["content"] if part.get("type") == "text"])
+    return {"role": msg["role"], "content": combined_text}
+
+
+def _prefix_at_special(tokenizer, text: str, input_ids):
+    """Cut a tokenized prompt just before its last added or special token.
+
+    Tokenizers split those tokens out before any merging, so text appended after
+    the cut tokenizes the same alone as it does in the full prompt. Returns
+    (text_prefix, ids_prefix), or None when there is no such token past the start.
+    """
+
+    special = set(getattr(tokenizer, "all_special_ids", None) or [])
+    special.update(getattr(tokenizer, "added_tokens_decoder", None) or {})
+    ids = input_ids[0].tolist()
+    for i in range(len(ids) - 1, 0, -1):
+        if ids[i] not in special:
+            continue
+        token = tokenizer.convert_ids_to_tokens(ids[i])
+        cut = text.rfind(token)
+        # Every occurrence of the token's text must be that token, so the last
+        # one in the text is the i-th id.
+        if cut <= 0 or ids.count(ids[i]) != text.count(token):
+            return None
+        return text[:cut], input_ids[:, :i]
+    return None
+
+
+def _estimate_params(config) -> int:
+    # Rough decoder-only count from the config: attention + MLP per layer, plus
+    # embeddings. Good enough to tell a 0.5B model from a 7B one.
+    cfg = getattr(config, "text_config", None) or config
+    hidden = getattr(cfg, "hidden_size", None) or 0
+    layers = getattr(cfg, "num_hidden_layers", None) or 0
+    vocab = getattr(cfg, "vocab_size", None) or 0
+    inter = getattr(cfg, "intermediate_size", None) or 4 * hidden
+    return layers * (4 * hidden * hidden + 3 * hidden * inter) + vocab * hidden
+
+
+def _cuda_int8_config():
+    try:
+        import bitsandbytes  # noqa: F401
+        from transformers import BitsAndBytesConfig
+    except Exception:
+        return None
+    return BitsAndBytesConfig(load_in_8bit=True)
+
+
+def _quantize_int8_cpu(model) -> bool:
+    try:
+        from torchao.quantization import quantize_
+        try:
+            from torchao.quantization import Int8WeightOnlyConfig
+
+            config = Int8WeightOnlyConfig()
+        except ImportError:
+            from torchao.quantization import int8_weight_only
+
+            config = int8_weight_only()
+        quantize_(model, config)
+    except Exception as e:
+        print(f"int8 quantization skipped: {e}", file=sys.stderr)
+        return False
+    return True
+
+
+def _warm_static_cache(model, tokenizer) -> bool:
+    """Allocate the static cache and compile the decode step before any request.
+
+    Must run on the thread that later runs generate(): CUDA graphs recorded by
+    torch.compile are per thread. The warm-up asks for a _STATIC_CACHE_LEN-token
+    generation and stops after a few decode steps, so the cache and the compiled
+    graph have the shapes every fitting request reuses.
+
+    Returns True when generate() should pass cache_implementation="static".
+    """
+
+    if not getattr(model, "_can_compile_fullgraph", getattr(model, "_supports_static_cache", False)):
+        return False
+
+    try:
+        # generate() only compiles static-cache decoding on versions that have it.
+        from transformers import CompileConfig  # noqa: F401
+        from transformers import StoppingCriteria, StoppingCriteriaList
+
+        class _StopAfter(StoppingCriteria):
+            def __init__(self, steps: int) -> None:
+                self.steps = steps
+
+            def __call__(self, *args, **kwargs):
+                self.steps -= 1
+                return self.steps < 0
+
+        warmup = tokenizer("Hello", return_tensors="pt").to(model.device)
+        model.generate(
+            **warmup,
+            max_new_tokens=_STATIC_CACHE_LEN - warmup["input_ids"].shape[-1],
+            do_sample=False,
+            cache_implementation="static",
+            stopping_criteria=StoppingCriteriaList([_StopAfter(4)]),
+        )
+    except Exception as e:
+        print(f"Static cache disabled: {e}", file=sys.stderr)
+        return False
+    return True
+
+
+class ProgressAggregator:
+    """Coalesce per-file byte counters into one download_progress message.
+
+    Workers call update() as often as they like; a background thread emits the
+    summed counters at most once per interval.
+    """
+
+    def __init__(
+        self,
+        download_id: str,
+        repo_id: str,
+        total: Optional[int],
+        interval: float = 0.2,
+    ) -> None:
+        self._download_id = download_id
+        self._repo_id = repo_id
+        self._total = total
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._counts: Dict[str, int] = {}
+        self._desc: Optional[str] = None
+        self._dirty = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def update(self, key: str, n_bytes: int) -> None:
+        with self._lock:
+            self._counts[key] = int(n_bytes)
+            self._desc = key
+            self._dirty = True
+
+    def flush(self) -> None:
+        with self._lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            n = sum(self._counts.values())
+            desc = self._desc
+        _send(
+            {
+                "type": "download_progress",
+                "download_id": self._download_id,
+                "repo_id": self._repo_id,
+                "n": n,
+                "total": self._total,
+                "desc": desc,
+            }
+        )
+
+    def close(self) -> None:
+        """Stop the background thread and emit any pending update."""
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+
+    def _run(self) -> None:
+        # Deadline-driven on the monotonic clock, so time spent in flush() does
+        # not stretch the interval and wall-clock jumps do not stall it.
+        next_emit = time.monotonic() + self._interval
+        while not self._stop.wait(max(0.0, next_emit - time.monotonic())):
+            self.flush()
+            next_emit = max(next_emit + self._interval, time.monotonic())
+
+
 class Runner:
     def __init__(self) -> None:
         self._lock = threading.Lock()
         self._loaded: Dict[str, Dict[str, Any]] = {}
         self._messages: Dict[str, List[Any]] = {}
+        # Same history as self._messages["messages"], content joined into strings.
+        self._messages_qwen_text: List[Dict[str, Any]] = []
+        # Per model: rendered text and input_ids of the last prompt (up to its
+        # last special token), reused as a prefix when the next prompt extends it.
+        self._prompt_cache: Dict[str, Dict[str, Any]] = {}
+        # Models whose incremental tokens did not match a full tokenization.
+        self._prompt_cache_off: set = set()
         self._cancel: Dict[str, threading.Event] = {}
         self._download_cancel: Dict[str, threading.Event] = {}
+        self._download_threads: List[threading.Thread] = []
+        # Static-cache models decode only on this thread: their compiled CUDA
+        # graphs are per thread, and they share one cache per model.
+        self._decode_pool = ThreadPoolExecutor(max_workers=1)
+
+    def _chat_inputs(self, model_id_norm: str, processor, tokenizer, messages: List[Dict[str, Any]]):
+        """Tokenize the chat prompt, tokenizing only what changed since the last turn.
+
+        The template is rendered to text (cheap); when it starts with the cached
+        prefix of the previous prompt, only the rest goes through the tokenizer
+        and its ids are appended to the cached ones. The prefix ends before a
+        special token, so no merge crosses the seam. The first reuse per model is
+        checked against a full tokenization, and a mismatch (e.g. a tokenizer
+        that prepends "▁" to every call) turns the cache off for that model.
+        Otherwise (first turn, a template that rewrites history, or a processor
+        returning extra inputs) the whole prompt is tokenized as before.
+        """
+
+        import torch
+        from transformers import BatchFeature
+
+        def tokenize_all():
+            return processor.apply_chat_template(
+                messages,
+                add_generation_prompt=True,
+                tokenize=True,
+                return_dict=True,
+                return_tensors="pt",
+            )
+
+        if model_id_norm in self._prompt_cache_off:
+            return tokenize_all()
+
+        text = processor.apply_chat_template(messages, add_generation_prompt=True, tokenize=False)
+        cached = self._prompt_cache.get(model_id_norm)
+        verified = cached is not None and cached["verified"]
+
+        if cached is not None and isinstance(text, str) and text.startswith(cached["text"]):
+            new_ids = tokenizer(
+                text[len(cached["text"]):], return_tensors="pt", add_special_tokens=False
+            )["input_ids"]
+            input_ids = torch.cat([cached["input_ids"], new_ids], dim=-1)
+            inputs = BatchFeature({"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)})
+            if not verified:
+                full = tokenize_all()
+                if not torch.equal(full["input_ids"], input_ids):
+                    print(f"Prompt cache disabled for {model_id_norm}: tokens differ", file=sys.stderr)
+                    self._prompt_cache.pop(model_id_norm, None)
+                    self._prompt_cache_off.add(model_id_norm)
+                    return full
+                verified = True
+        else:
+            inputs = tokenize_all()
+            if not isinstance(text, str) or not set(inputs.keys()) <= {"input_ids", "attention_mask"}:
+                self._prompt_cache.pop(model_id_norm, None)
+                return inputs
+            input_ids = inputs["input_ids"]
+
+        prefix = _prefix_at_special(tokenizer, text, input_ids)
+        if prefix is None:
+            self._prompt_cache.pop(model_id_norm, None)
+        else:
+            self._prompt_cache[model_id_norm] = {"text": prefix[0], "input_ids": prefix[1], "verified": verified}
+        return inputs
+
+    def _unload_models(self, torch) -> None:
+        """Drop every loaded model and hand its memory back to the device."""
+
+        with self._lock:
+            loaded, self._loaded = self._loaded, {}
+        compiled = any(entry.get("static_cache") for entry in loaded.values())
+        for entry in loaded.values():
+            entry.clear()
+        del loaded
+        self._prompt_cache.clear()
+
+        # Compiled graphs (and their CUDA graph pools) keep the old model alive.
+        if compiled:
+            torch._dynamo.reset()
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+            torch.cuda.ipc_collect()
+        elif torch.backends.mps.is_available():
+            torch.mps.empty_cache()
 
     def cancel(self, generation_id: str) -> None:
         with self._lock:
@@ -170,6 +1138,39 @@ class Runner:
         if ev is not None:
             ev.set()
 
+    def start_download(
+        self,
+        download_id: str,
+        repo_id: str,
+        revision: Optional[str],
+        local_dir: Optional[str],
+        token: Optional[str],
+    ) -> None:
+        thread = threading.Thread(
+            target=self.download_model,
+            args=(download_id, repo_id, revision, local_dir, token),
+            daemon=True,
+        )
+        with self._lock:
+            self._download_threads = [t for t in self._download_threads if t.is_alive()]
+            self._download_threads.append(thread)
+        thread.start()
+
+    def stop_downloads(self) -> None:
+        """Cancel every active download and wait for it to wind down.
+
+        Download threads are daemons; without this their cleanup (closing and
+        trimming partial files) would be skipped when main() returns.
+        """
+
+        with self._lock:
+            events = list(self._download_cancel.values())
+            threads = list(self._download_threads)
+        for ev in events:
+            ev.set()
+        for thread in threads:
+            thread.join()
+
     def download_model(
         self,
         download_id: str,
@@ -187,6 +1188,7 @@ class Runner:
 
         try:
             HfApi, hf_hub_download, hf_hub_url = _import_hf_hub()
+            hf_transfer = _import_hf_transfer()
 
             _send(
                 {
@@ -201,18 +1203,22 @@ class Runner:
             # Byte-based progress: fetch file metadata (sizes) once.
             info = api.model_info(repo_id, revision=revision, files_metadata=True, token=token)
 
-            files = [getattr(s, "rfilename", None) for s in getattr(info, "siblings", []) or []]
-            files = [f for f in files if isinstance(f, str) and f]
+            sibling_by_name = {
+                getattr(s, "rfilename", None): s for s in getattr(info, "siblings", []) or []
+            }
+            files = [f for f in sibling_by_name if isinstance(f, str) and f]
             if not files:
                 raise RuntimeError("No files found in repo")
 
-            # Precompute total bytes.
+            # Precompute total bytes and download URLs.
             per_file_size: Dict[str, Optional[int]] = {}
+            urls: Dict[str, str] = {}
             total_bytes = 0
             unknown = False
             for filename in files:
-                sz = _file_expected_size_from_model_info(info, filename)
+                sz = _sibling_size(sibling_by_name[filename])
                 per_file_size[filename] = sz
+                urls[filename] = hf_hub_url(repo_id=repo_id, filename=filename, revision=revision, repo_type="model")
                 if isinstance(sz, int) and sz > 0:
                     total_bytes += sz
                 else:
@@ -233,60 +1239,76 @@ class Runner:
                 }
             )
 
-            downloaded_bytes = 0
+            if not local_dir:
+                raise RuntimeError("Missing local_dir")
 
-            def emit_progress(n_bytes: int, desc: Optional[str] = None) -> None:
-                payload = {
-                    "type": "download_progress",
-                    "download_id": download_id,
-                    "repo_id": repo_id,
-                    "n": int(n_bytes),
-                    "total": total_for_ui,
-                    "desc": desc,
-                }
-                _send(payload)
+            # Per-file byte counters, reported as one summed progress message every 200 ms.
+            agg = ProgressAggregator(download_id, repo_id, total_for_ui)
 
-            for filename in files:
+            def fetch(filename: str) -> None:
                 if cancel_event.is_set():
                     raise RuntimeError("Download cancelled")
 
-                emit_progress(downloaded_bytes, filename)
-
-                # Determine destination path inside local_dir
-                if not local_dir:
-                    raise RuntimeError("Missing local_dir")
                 dest_path = os.path.join(local_dir, filename)
-
                 expected_size = per_file_size.get(filename)
+                url = urls[filename]
 
-                # Build URL and stream download. This yields frequent progress updates even
-                # for a single multi-GB safetensors shard.
-                url = hf_hub_url(repo_id=repo_id, filename=filename, revision=revision, repo_type="model")
-
-                before = downloaded_bytes
-
-                def on_progress(n_total_for_this_file: int) -> None:
-                    # n_total_for_this_file includes already-present bytes for this file
-                    # overall_base was 'before'.
-                    emit_progress(n_total_for_this_file, filename)
-
-                written = _download_streaming(
-                    url=url,
-                    dest_path=dest_path,
-                    token=token,
-                    expected_size=expected_size,
-                    cancel_event=cancel_event,
-                    on_progress=on_progress,
-                    overall_base=before,
+                on_progress = lambda n: agg.update(filename, n)
+
+                already_complete = (
+                    isinstance(expected_size, int)
+                    and os.path.exists(dest_path)
+                    and os.path.getsize(dest_path) == expected_size
                 )
 
-                # Advance overall counter by the file's expected size if known, else by written.
+                # hf_transfer cannot resume: partial files stay on the ranged path.
+                if (
+                    hf_transfer is not None
+                    and not already_complete
+                    and isinstance(expected_size, int)
+                    and expected_size >= _HF_TRANSFER_MIN_SIZE
+                    and not _has_partial(dest_path, expected_size)
+                ):
+                    written = _download_hf_transfer(
+                        hf_transfer=hf_transfer,
+                        url=url,
+                        dest_path=dest_path,
+                        token=token,
+                        expected_size=expected_size,
+                        cancel_event=cancel_event,
+                        on_progress=on_progress,
+                    )
+                else:
+                    written = _download_streaming(
+                        url=url,
+                        dest_path=dest_path,
+                        token=token,
+                        expected_size=expected_size,
+                        cancel_event=cancel_event,
+                        on_progress=on_progress,
+                        overall_base=0,
+                    )
+
+                # Count the file by its expected size if known, else by written.
                 if isinstance(expected_size, int) and expected_size > 0:
-                    downloaded_bytes = before + expected_size
+                    agg.update(filename, expected_size)
                 else:
-                    downloaded_bytes = before + int(written)
+                    agg.update(filename, written)
 
-                emit_progress(downloaded_bytes, filename)
+            try:
+                with ThreadPoolExecutor(max_workers=_DOWNLOAD_WORKERS) as pool:
+                    futures = [pool.submit(fetch, filename) for filename in files]
+                    try:
+                        for future in as_completed(futures):
+                            future.result()
+                    except BaseException:
+                        # Stop queued files and make in-flight ones bail out at their next chunk.
+                        cancel_event.set()
+                        for future in futures:
+                            future.cancel()
+                        raise
+            finally:
+                agg.close()
 
             path = local_dir or ""
             
@@ -333,6 +1355,7 @@ class Runner:
             
             import torch
             from transformers import (
+                AutoConfig,
                 AutoProcessor,
                 AutoModelForCausalLM,
                 TextIteratorStreamer,
@@ -358,13 +1381,10 @@ class Runner:
 
             if self._loaded.get(model_id_norm) == None:
                 
-                # Unload other models to free up memory
-                with self._lock:
-                    self._loaded = {}
+                # Unload other models to free up memory before loading the next one
+                if self._loaded:
+                    self._unload_models(torch)
 
-                # Quantization
-                # quant_config = HqqConfig(nbits=8, group_size=64) -> Use quant just for NVIDIA GPU
-                
                 try:
                     if "qwen" in model_id_norm.lower():
                         raise RuntimeError("Qwen models do not support AutoProcessor")
@@ -377,24 +1397,54 @@ class Runner:
                     as_processor_tokenizer = False
                     
                     
+                # Quantization (opt-in): int8 weights halve weight traffic per token.
+                # Small models are left alone; activations stay in bfloat16.
+                quantize = _QUANTIZE and select_device() in ("cuda", "cpu")
+                if quantize:
+                    try:
+                        config = AutoConfig.from_pretrained(model_name, local_files_only=True)
+                        quantize = _estimate_params(config) >= _QUANT_MIN_PARAMS
+                    except Exception:
+                        quantize = False
+
+                load_kwargs: Dict[str, Any] = {}
+                if quantize and select_device() == "cuda":
+                    quant_config = _cuda_int8_config()
+                    if quant_config is not None:
+                        load_kwargs["quantization_config"] = quant_config
+
                 model = AutoModelForCausalLM.from_pretrained(
                     model_name,
                     local_files_only=True,
                     dtype=torch.bfloat16,
                     device_map=select_device(), 
-                    # quantization_config=quant_config,
+                    **load_kwargs,
                 )
+
+                quantized = "quantization_config" in load_kwargs
+                if quantize and select_device() == "cpu":
+                    quantized = _quantize_int8_cpu(model)
                 
-                print(f"Using device: {select_device()}", file=sys.stderr)
+                print(f"Using device: {select_device()} (int8: {quantized})", file=sys.stderr)
+                
+                static_cache = False
+                # bitsandbytes int8 layers do not compile; keep those eager.
+                if _TORCH_COMPILE and select_device() == "cuda" and not quantized:
+                    tokenizer = processor.tokenizer if as_processor_tokenizer else processor
+                    static_cache = self._decode_pool.submit(_warm_static_cache, model, tokenizer).result()
                 
                 self._loaded[model_id_norm] = {
                     "processor": processor,
-                    "model": model
+                    "model": model,
+                    "as_processor_tokenizer": as_processor_tokenizer,
+                    "static_cache": static_cache,
                 }
                 
             else:
                 processor = self._loaded[model_id_norm]["processor"]
                 model = self._loaded[model_id_norm]["model"]
+                as_processor_tokenizer = self._loaded[model_id_norm]["as_processor_tokenizer"]
+                static_cache = self._loaded[model_id_norm]["static_cache"]
 
             if self._messages.get("messages") == None:
                 messages = [
@@ -425,41 +1475,30 @@ class Runner:
                         }
                 ]
                 self._messages["messages"] = messages
+                self._messages_qwen_text = [_as_text_message(msg) for msg in messages]
             else:
                 messages = self._messages["messages"]
             
             # Add user prompt to messages
-            messages.append({
+            user_msg = {
                 "role": "user",
                 "content": [{"type": "text", "text": prompt}],
-            })
-            
+            }
+            messages.append(user_msg)
+            self._messages_qwen_text.append(_as_text_message(user_msg))
             
-            # Adapt messages if model is Qwen, which do not accept list on content
-            updated_messages = []
             
+            # Qwen models do not accept list on content; use the text-only history
+            # kept alongside, so it is never rebuilt per turn.
             if "qwen" in model_id_norm.lower():
-                for msg in messages:
-                    if isinstance(msg["content"], list):
-                        combined_text = " ".join([part["text"] for part in msg["content"] if part.get("type") == "text"])
-                        updated_messages.append({
-                            "role": msg["role"],
-                            "content": combined_text
-                        })
-                    else:
-                        updated_messages.append(msg)
-                updated_messages
+                updated_messages = self._messages_qwen_text
             else:
                 updated_messages = messages
 
+            tokenizer = processor.tokenizer if as_processor_tokenizer else processor
+
             # Aplica o chat template
-            inputs = processor.apply_chat_template(
-                updated_messages,
-                add_generation_prompt=True,
-                tokenize=True,
-                return_dict=True,
-                return_tensors="pt",
-            )
+            inputs = self._chat_inputs(model_id_norm, processor, tokenizer, updated_messages)
             
             if as_processor_tokenizer:
                 inputs = inputs.to(model.device, dtype=torch.bfloat16)
@@ -476,8 +1515,6 @@ class Runner:
 
             do_sample = float(temperature) > 0.0 and not select_device() == "mps"
             
-            tokenizer = processor.tokenizer if as_processor_tokenizer else processor
-            
             streamer = TextIteratorStreamer(tokenizer, skip_special_tokens=True, skip_prompt=True)
 
             generation_kwargs = {
@@ -488,6 +1525,11 @@ class Runner:
                 "use_cache": True,
                 "streamer": streamer,
             }
+            # Only when the whole generation fits the warmed-up cache; a bigger
+            # one would mean a new cache shape and a recompile.
+            static_cache = static_cache and inputs["input_ids"].shape[-1] + max_new_tokens <= _STATIC_CACHE_LEN
+            if static_cache:
+                generation_kwargs["cache_implementation"] = "static"
 
             # This exists to allow stopping criteria to access the cancel_event
 
@@ -498,31 +1540,47 @@ class Runner:
             generation_kwargs["stopping_criteria"] = StoppingCriteriaList([_CancelStop()])
 
             # Gera em thread separada
-            thread = threading.Thread(target=model.generate, kwargs=generation_kwargs)
-            thread.start()
+            if static_cache:
+                decode = self._decode_pool.submit(model.generate, **generation_kwargs)
+            else:
+                thread = threading.Thread(target=model.generate, kwargs=generation_kwargs)
+                thread.start()
 
             full_response = ""
+            pending = ""
+            last_send = time.monotonic()
             for new_text in streamer:
                 
                 full_response += new_text
-                _send({"type": "chat_token", "generation_id": generation_id, "token": new_text})
+                pending += new_text
+                now = time.monotonic()
+                if len(pending) >= _TOKEN_FLUSH_CHARS or (now - last_send) >= _TOKEN_FLUSH_INTERVAL:
+                    _send({"type": "chat_token", "generation_id": generation_id, "token": pending})
+                    pending = ""
+                    last_send = now
                 
                 # Condição customizada para parar
                 # if len(full_response) > 500:
                 #     break
-                
-                if (cancel_event.is_set()):
-                    print(f"Generation cancelled: {generation_id}", file=sys.stderr)
-                    thread.join(timeout=1.0)
-                    break
 
-            thread.join()
+            if pending:
+                _send({"type": "chat_token", "generation_id": generation_id, "token": pending})
+
+            # _CancelStop ends model.generate on cancel, which also ends the streamer.
+            if static_cache:
+                decode.result()
+            else:
+                thread.join()
+            if cancel_event.is_set():
+                print(f"Generation cancelled: {generation_id}", file=sys.stderr)
             _send({"type": "done", "generation_id": generation_id})
             
-            messages.append({
+            assistant_msg = {
                 "role": "assistant",
                 "content": [{"type": "text", "text": full_response}],
-            })
+            }
+            messages.append(assistant_msg)
+            self._messages_qwen_text.append(_as_text_message(assistant_msg))
             
             self._messages["messages"] = messages
             
@@ -539,12 +1597,12 @@ def main() -> None:
     runner = Runner()
     _send({"type": "ready"})
 
-    for line in sys.stdin:
+    for line in _stdin_lines():
         line = line.strip()
         if not line:
             continue
         try:
-            msg = json.loads(line)
+            msg = _loads(line)
         except Exception:
             _send({"type": "error", "generation_id": None, "message": "Invalid JSON"})
             continue
@@ -552,6 +1610,7 @@ def main() -> None:
         msg_type = msg.get("type")
 
         if msg_type == "shutdown":
+            runner.stop_downloads()
             _send({"type": "shutdown"})
             return
 
@@ -601,11 +1660,7 @@ def main() -> None:
             if token is not None and not isinstance(token, str):
                 token = None
 
-            threading.Thread(
-                target=runner.download_model,
-                args=(download_id, repo_id, revision, local_dir, token),
-                daemon=True,
-            ).start()
+            runner.start_download(download_id, repo_id, revision, local_dir, token)
             continue
         
         if msg_type == "generate":
@@ -641,6 +1696,9 @@ def main() -> None:
 
         _send({"type": "error", "generation_id": None, "message": f"Unknown type: {msg_type}"})
 
+    # stdin closed: the app went away without a shutdown message.
+    runner.stop_downloads()
+
 
 if __name__ == "__main__":
     main()